@@ -7,7 +7,13 @@ from astropy.table import Table
 from astropy.coordinates import SkyCoord
 import astropy.units as u 
 
-def read_associations(folder,target,scalepc,HSTband='nuv',version='v1p1',data='all'):
+try:
+    # cfitsio is considerably faster than astropy for reading large files
+    import fitsio
+except ImportError:
+    fitsio = None
+
+def read_associations(folder,target,scalepc,HSTband='nuv',version='v1p1',data='all',integer_mask=False,all_columns=False):
     '''read the catalogue and spatial mask for the associations
     
     Parameters
@@ -27,6 +33,17 @@ def read_associations(folder,target,scalepc,HSTband='nuv',version='v1p1',data='a
 
     data : string
         'all', 'catalogue', 'mask'
+
+    integer_mask : bool
+        By default the spatial mask is a float array with NaN for pixels
+        without an association. With `integer_mask=True` the mask is 
+        memory-mapped and keeps the integer IDs (0 is the background),
+        which avoids a full float copy of the image.
+
+    all_columns : bool
+        By default the catalogue is narrowed to the renamed columns and 
+        the fluxes (`*mjy` and `*mjy_err`). Use `all_columns=True` to 
+        read every column of the catalogue.
     '''
     
     folder = folder/f'associations {version}'/'multi-scale stellar associations'
@@ -45,20 +62,33 @@ def read_associations(folder,target,scalepc,HSTband='nuv',version='v1p1',data='a
     if data=='all' or data=='catalogue':
         # first the association catalogue
         catalogue_file = folder / f'{target}_phangshst_associations_{HSTband}_ws{scalepc}pc_{version}.fits'
-        with fits.open(catalogue_file) as hdul:
-            associations = Table(hdul[1].data)
+        # unless all_columns is set, only the renamed and converted columns are read
+        renamed_columns = ['reg_id','reg_ra','reg_dec','reg_x','reg_y',
+                          'reg_dolflux_Age_MinChiSq','reg_dolflux_Mass_MinChiSq','reg_dolflux_Ebv_MinChiSq',
+                          'reg_dolflux_Age_MinChiSq_err','reg_dolflux_Mass_MinChiSq_err','reg_dolflux_Ebv_MinChiSq_err']
+        if fitsio:
+            with fitsio.FITS(catalogue_file) as hdul:
+                columns = [col for col in hdul[1].get_colnames() 
+                           if all_columns or col in renamed_columns or col.endswith(('mjy','mjy_err'))]
+                associations = Table(hdul[1].read(columns=columns))
+        else:
+            with fits.open(catalogue_file,memmap=True) as hdul:
+                columns = [col for col in hdul[1].columns.names 
+                           if all_columns or col in renamed_columns or col.endswith(('mjy','mjy_err'))]
+                associations = Table([hdul[1].data[col] for col in columns],names=columns)
 
         # modify table (rename the columns such that the clusters and associations are identical)
         associations['SkyCoord'] = SkyCoord(associations['reg_ra']*u.degree,associations['reg_dec']*u.degree)
-        associations.rename_columns(['reg_id','reg_ra','reg_dec','reg_x','reg_y',
-                                    'reg_dolflux_Age_MinChiSq','reg_dolflux_Mass_MinChiSq','reg_dolflux_Ebv_MinChiSq',
-                                    'reg_dolflux_Age_MinChiSq_err','reg_dolflux_Mass_MinChiSq_err','reg_dolflux_Ebv_MinChiSq_err'],
+        associations.rename_columns(renamed_columns,
                                     ['assoc_ID','RA','DEC','X','Y','age','mass','EBV','age_err','mass_err','EBV_err'])
-        for col in list(associations.columns):
-            if col.endswith('mjy'):
-                associations[f'{col.split("_")[0]}_FLUX'] = 1e20*associations[col]*u.mJy.to(u.erg/u.s/u.cm**2/u.Hz)
-            if col.endswith('mjy_err'):
-                associations[f'{col.split("_")[0]}_FLUX_ERR'] = 1e20*associations[col]*u.mJy.to(u.erg/u.s/u.cm**2/u.Hz)
+        # convert the fluxes from mJy to 1e-20 erg/s/cm2/Hz
+        conversion = 1e20*u.mJy.to(u.erg/u.s/u.cm**2/u.Hz)
+        flux_cols = [col for col in associations.columns if col.endswith('mjy')]
+        err_cols  = [col for col in associations.columns if col.endswith('mjy_err')]
+        for col in flux_cols:
+            associations[f'{col.split("_")[0]}_FLUX'] = conversion*associations[col].data
+        for col in err_cols:
+            associations[f'{col.split("_")[0]}_FLUX_ERR'] = conversion*associations[col].data
 
 
 
@@ -68,13 +98,27 @@ def read_associations(folder,target,scalepc,HSTband='nuv',version='v1p1',data='a
     if data=='all' or data=='mask':
         # next the spatial masks for the associations
         mask_file = folder / f'{target}_phangshst_associations_{HSTband}_ws{scalepc}pc_idmask_{version}.fits'
-        with fits.open(mask_file) as hdul:
-            mask = hdul[0].data.astype(float)
-            mask[mask==0] = np.nan
-            associations_mask = NDData(mask,
-                                    mask=mask==0,
-                                    meta=hdul[0].header,
-                                    wcs=WCS(hdul[0].header))
+        if integer_mask:
+            # fitsio reads the entire image, hence astropy is used for the memmap
+            with fits.open(mask_file,memmap=True) as hdul:
+                mask = hdul[0].data
+                header = hdul[0].header
+            bkg = mask==0
+        else:
+            if fitsio:
+                mask_data = fitsio.read(mask_file,ext=0)
+                header = fits.getheader(mask_file,ext=0)
+            else:
+                with fits.open(mask_file) as hdul:
+                    mask_data = hdul[0].data
+                    header = hdul[0].header
+            mask = mask_data.astype(float)
+            bkg = mask==0
+            mask[bkg] = np.nan
+        associations_mask = NDData(mask,
+                                mask=bkg,
+                                meta=header,
+                                wcs=WCS(header))
         if data=='mask':
             return associations_mask
 
@@ -1,5 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
 from astropy.nddata import Cutout2D
 from astropy.visualization import simple_norm
@@ -8,64 +9,205 @@ import astropy.units as u
 
 from reproject import reproject_interp
 from regions import PixCoord, RectangleSkyRegion
-from skimage.measure import find_contours
+from skimage.measure import find_contours, regionprops
+from skimage.transform import downscale_local_mean
 
 from pnlf.plot import add_scale, create_RGB
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 single_column = 3.321 # in inch
 two_column    = 6.974 # in inch
 
-def single_cutout(ax,position,image,mask1=None,mask2=None,points=None,label=None,size=6*u.arcsec):
+def find_region_contours(mask,bkg=None):
+    '''find the outlines of all regions in a mask
+
+    Instead of scanning the entire mask once for every region, each 
+    region is traced only inside its bounding box (padded by one pixel
+    such that the result is identical to tracing the full mask).
+    Contouring the label image directly (e.g. with `ax.contour` and 
+    levels between the IDs) is not an option, because adjacent regions
+    with non-consecutive IDs would get several parallel outlines.
+
+    Parameters
+    ----------
+
+    mask : ndarray
+        mask with the region IDs (NaN marks the background)
+
+    bkg : float
+        additional value that marks the background (e.g. 0 for the 
+        association masks)
+
+    Returns
+    -------
+    contours : dict
+        the contours of each region (region_ID as key)
+    '''
+
+    if np.issubdtype(mask.dtype,np.integer):
+        # integer masks can not contain NaN and need no extra filtering
+        valid = mask!=bkg if bkg is not None else np.ones(mask.shape,dtype=bool)
+    else:
+        valid = ~np.isnan(mask)
+        if bkg is not None:
+            valid &= mask!=bkg
+    region_ID, inverse = np.unique(mask[valid],return_inverse=True)
+
+    # relabel the regions to consecutive integers (0 is the background)
+    # with the smallest possible dtype (usually uint8 for a cutout)
+    labels = np.zeros(mask.shape,dtype=np.min_scalar_type(len(region_ID)))
+    labels[valid] = inverse + 1
+
+    # the bounding box of each region (numba is faster if available)
+    if njit:
+        bboxes = _bounding_boxes(labels,len(region_ID))
+    else:
+        bboxes = [region.bbox for region in regionprops(labels)]
+
+    contours = {}
+    for label,(r0,c0,r1,c1) in enumerate(bboxes,start=1):
+        r0, c0 = max(r0-1,0), max(c0-1,0)
+        r1, c1 = min(r1+1,mask.shape[0]), min(c1+1,mask.shape[1])
+        local = labels[r0:r1,c0:c1]==label
+        contours[region_ID[label-1]] = [c+(r0,c0) for c in find_contours(local,0.5)]
+
+    return contours
+
+if njit:
+    @njit(cache=True)
+    def _bounding_boxes(labels,n):
+        '''bounding boxes of the labels 1 to n in a single pass over the image'''
+
+        bboxes = np.empty((n,4),dtype=np.int64)
+        bboxes[:,0] = labels.shape[0]
+        bboxes[:,1] = labels.shape[1]
+        bboxes[:,2] = 0
+        bboxes[:,3] = 0
+        for i in range(labels.shape[0]):
+            for j in range(labels.shape[1]):
+                k = np.int64(labels[i,j])-1
+                if k>=0:
+                    bboxes[k,0] = min(bboxes[k,0],i)
+                    bboxes[k,1] = min(bboxes[k,1],j)
+                    bboxes[k,2] = max(bboxes[k,2],i+1)
+                    bboxes[k,3] = max(bboxes[k,3],j+1)
+        return bboxes
+
+def reproject_masks(masks,output_projection,shape_out):
+    '''nearest-neighbour reprojection of several masks onto the same grid
+
+    The sky coordinates of the output grid are computed only once and 
+    masks that share the same WCS also share the pixel transformation.
+
+    Parameters
+    ----------
+
+    masks : list of NDData
+        the masks that are reprojected
+    
+    output_projection : WCS
+        the WCS of the output grid
+
+    shape_out : tuple
+        the shape of the output grid
+
+    Returns
+    -------
+    reprojected : list of ndarray
+        the reprojected masks. Float masks are NaN outside of the input 
+        footprint, integer masks keep their dtype and are 0 outside.
+    '''
+
+    y, x = np.indices(shape_out)
+    world = output_projection.pixel_to_world(x,y)
+
+    reprojected = []
+    cached_wcs, cached_pixels = None, None
+    for mask in masks:
+        if cached_wcs is None or not mask.wcs.wcs.compare(cached_wcs.wcs) or mask.data.shape!=cached_pixels[0]:
+            xi, yi = mask.wcs.world_to_pixel(world)
+            xi, yi = np.round(xi), np.round(yi)
+            inside = (xi>=0) & (xi<mask.data.shape[1]) & (yi>=0) & (yi<mask.data.shape[0])
+            cached_wcs = mask.wcs
+            cached_pixels = (mask.data.shape,inside,yi[inside].astype(int),xi[inside].astype(int))
+        _, inside, yi, xi = cached_pixels
+
+        if np.issubdtype(mask.data.dtype,np.integer):
+            out = np.zeros(shape_out,dtype=mask.data.dtype)
+        else:
+            out = np.full(shape_out,np.nan)
+        out[inside] = mask.data[yi,xi]
+        reprojected.append(out)
+
+    return reprojected
+
+def single_cutout(ax,position,image,mask1=None,mask2=None,points=None,label=None,size=6*u.arcsec,preview=False,pixel=None):
+    '''Plot a cutout of the image with the outlines of the masks
+
+    With `preview=True`, cutouts that are much larger than the axes are
+    binned down to roughly the displayed resolution before plotting.
+    `pixel` is the (optional) precomputed pixel position of `position` 
+    in `image` and saves the conversion if many cutouts are created.
+    '''
     
-    cutout_image = Cutout2D(image.data,position,size=size,wcs=image.wcs)
+    cutout_image = Cutout2D(image.data,position if pixel is None else pixel,size=size,wcs=image.wcs)
     norm = simple_norm(cutout_image.data,clip=False,stretch='linear',percent=99.5)
 
-    ax.imshow(cutout_image.data,origin='lower',norm=norm,cmap=plt.cm.gray_r)
+    data = cutout_image.data
+    extent = None
+    if preview:
+        bbox = ax.get_window_extent()
+        factor = int(max(1,min(data.shape)//max(1,min(bbox.width,bbox.height))))
+        if factor>1:
+            # trim to a multiple of the factor and keep the pixel coordinates of the full cutout
+            ny, nx = data.shape[0]//factor*factor, data.shape[1]//factor*factor
+            data = downscale_local_mean(data[:ny,:nx],(factor,factor))
+            extent = (-0.5,nx-0.5,-0.5,ny-0.5)
+    ax.imshow(data,origin='lower',norm=norm,cmap=plt.cm.gray_r,extent=extent)
+
+    # both masks are reprojected onto the same grid in one go
+    cutout_masks = reproject_masks([m for m in (mask1,mask2) if m],cutout_image.wcs,cutout_image.shape)
 
     # plot the nebulae catalogue
-    cutout_mask, _  = reproject_interp(mask1,output_projection=cutout_image.wcs,shape_out=cutout_image.shape,order='nearest-neighbor')    
-    region_ID = np.unique(cutout_mask[~np.isnan(cutout_mask)])
+    cutout_mask = cutout_masks[0]
 
-    contours = []
-    for i in region_ID:
-        blank_mask = np.zeros_like(cutout_mask)
-        blank_mask[cutout_mask==i] = 1
-        contours += find_contours(blank_mask, 0.5)
-
-    for coords in contours:
-        ax.plot(coords[:,1],coords[:,0],color='tab:red',lw=1,label='HII-region')
+    contours = [c for cs in find_region_contours(cutout_mask).values() for c in cs]
+    ax.add_collection(LineCollection([coords[:,::-1] for coords in contours],color='tab:red',lw=1,label='HII-region'))
 
 
-    mask = np.zeros((*cutout_mask.shape,4))
-    mask[~np.isnan(cutout_mask.data),:] = (0.84, 0.15, 0.16,0.1)
-    ax.imshow(mask,origin='lower')
+    mask = np.empty((*cutout_mask.shape,4),dtype=np.float32)
+    mask[...,:3] = (0.84, 0.15, 0.16)
+    mask[...,3] = np.where(np.isnan(cutout_mask),0,0.1)
+    ax.imshow(mask,origin='lower',rasterized=True)
 
     # plot the association catalogue
     if mask2:
-        cutout_mask, _  = reproject_interp(mask2,output_projection=cutout_image.wcs,shape_out=cutout_image.shape,order='nearest-neighbor')    
-        region_ID = np.unique(cutout_mask[~np.isnan(cutout_mask)])
+        cutout_mask = cutout_masks[1]
 
-        contours = []
-        for i in region_ID:
-            blank_mask = np.zeros_like(cutout_mask)
-            blank_mask[cutout_mask==i] = 1
-            contours += find_contours(blank_mask, 0.5)
+        contours = [c for cs in find_region_contours(cutout_mask,bkg=0).values() for c in cs]
+        ax.add_collection(LineCollection([coords[:,::-1] for coords in contours],color='tab:blue',lw=1,label='association'))
 
-        for coords in contours:
-            ax.plot(coords[:,1],coords[:,0],color='tab:blue',lw=1,label='association')
-
-        mask = np.zeros((*cutout_mask.shape,4))
-        mask[~np.isnan(cutout_mask.data),:] = (0.12,0.47,0.71,0.1)
-        ax.imshow(mask,origin='lower')
+        mask = np.empty((*cutout_mask.shape,4),dtype=np.float32)
+        mask[...,:3] = (0.12,0.47,0.71)
+        if np.issubdtype(cutout_mask.dtype,np.integer):
+            mask[...,3] = np.where(cutout_mask!=0,0.1,0)
+        else:
+            mask[...,3] = np.where(np.isnan(cutout_mask) | (cutout_mask==0),0,0.1)
+        ax.imshow(mask,origin='lower',rasterized=True)
 
     # mark the position of the clusters within the cutout
     if points:
         region = RectangleSkyRegion(position,0.9*size,0.9*size)
         in_frame = points[region.contains(points['SkyCoord'],cutout_image.wcs)]
-        for row in in_frame:
-            x,y = row['SkyCoord'].to_pixel(cutout_image.wcs)
-            if 5<x<cutout_image.data.shape[0]-5 and 5<y<cutout_image.data.shape[1]-5:
-                ax.scatter(x,y,marker='o',facecolors='none',s=20,lw=0.4,color='tab:blue',label='cluster')
+        x,y = in_frame['SkyCoord'].to_pixel(cutout_image.wcs)
+        ny, nx = cutout_image.data.shape
+        inside = (x>5) & (x<nx-5) & (y>5) & (y<ny-5)
+        if np.any(inside):
+            ax.scatter(x[inside],y[inside],marker='o',facecolors='none',s=20,lw=0.4,color='tab:blue',label='cluster')
 
     if label:
         t = ax.text(0.06,0.87,label, transform=ax.transAxes,color='black',fontsize=8)
@@ -126,10 +268,83 @@ def multi_cutout(positions,image,mask1=None,mask2=None,points=None,labels=None,
     plt.show()
 
 from matplotlib.backends.backend_pdf import PdfPages
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from io import BytesIO
 import datetime
 
+def cutout_page(fig,axes,positions,image,mask1=None,mask2=None,labels=None,last_page=False,pixels=None):
+    '''Fill one page of multi_page_cutout
+
+    Parameters
+    ----------
+
+    fig : Figure
+        the figure of the page
+
+    axes : ndarray
+        the axes of the page
+
+    last_page : bool
+        the last page has a legend and the unused axes are hidden
+
+    pixels : list
+        the pixel positions of `positions` in `image`
+    '''
+
+    axes_iter = iter(axes.flatten())
+    if pixels is None:
+        pixels = len(positions)*[None]
+
+    for position,label,pixel in zip(positions,labels,pixels):  
+
+        ax = next(axes_iter)
+        ax = single_cutout(ax,
+                            position = position,
+                            image = image,
+                            mask1 = mask1,
+                            mask2 = mask2,
+                            label = label,
+                            size  = 4*u.arcsecond,
+                            pixel = pixel)
+
+    fig.subplots_adjust(wspace=-0.1, hspace=0)
+    
+    # only the last page has subplots that need to be removed
+    if last_page:
+        # only add one handle per object to the legend
+        by_label = {}
+        for a in fig.axes:
+            for h,l in zip(*a.get_legend_handles_labels()):
+                by_label.setdefault(l,h)
+        ax = next(axes_iter)
+        ax.axis('off')
+        ax.legend(by_label.values(),by_label.keys(),fontsize=7,loc='center',frameon=False)
+        t = ax.text(0.06,0.87,'region ID/assoc ID', transform=ax.transAxes,color='black',fontsize=8)
+
+        for ax in axes_iter:
+            # remove the empty axes at the bottom
+            ax.axis('off')    
+
+    return fig
+
+# the large arrays are inherited by the forked worker processes (nothing
+# is pickled, a memory-mapped mask stays memory-mapped)
+_page_data = {}
+
+def _render_page(positions,labels,pixels,nrows,ncols,figsize,last_page,dpi):
+    '''render one page in a worker process and return it as png'''
+
+    fig, axes = plt.subplots(nrows=nrows,ncols=ncols,figsize=figsize)
+    cutout_page(fig,axes,positions,labels=labels,last_page=last_page,pixels=pixels,**_page_data)
+    buf = BytesIO()
+    fig.savefig(buf,format='png',dpi=dpi)
+    plt.close(fig)
+
+    return buf.getvalue()
+
 def multi_page_cutout(positions,image,mask1=None,mask2=None,points=None,labels=None,
-                 filename=None,size=6*u.arcsec,nrows=5,ncols=4):
+                 filename=None,size=6*u.arcsec,nrows=5,ncols=4,n_jobs=1,dpi=300):
     '''Plot multiple cutouts with the positoin of the clusters
     
     Parameters
@@ -143,53 +358,67 @@ def multi_page_cutout(positions,image,mask1=None,mask2=None,points=None,labels=N
         A mask with outlines
     points : SkyCoord
         Points to mark in the image
+    n_jobs : int
+        number of processes that render the pages in parallel. For
+        n_jobs>1 each page is embedded as one raster image with `dpi`,
+        i.e. the outlines and text are no longer vector graphics and the
+        pdf is considerably larger than with n_jobs=1. The workers are 
+        forked (without copying the image and masks), hence this is only
+        available on platforms that support the fork start method.
+    dpi : int
+        resolution of the rasterized images in the pdf
 
     '''
     
     width = 8.27
+    figsize = (width,width/ncols*nrows)
     N = len(positions)
     Npage = nrows*ncols
     Npages = int(np.ceil(N/Npage))
+
+    # index the positions once per page and iterate over a plain list of labels
+    labels = list(labels) if labels is not None else N*[None]
+    page_index = np.split(np.arange(N),np.arange(Npage,N,Npage))
+
+    # convert all positions to pixel coordinates at once
+    xs, ys = positions.to_pixel(image.wcs)
+    pages = [(positions[idx],[labels[j] for j in idx],list(zip(xs[idx],ys[idx])),i==Npages-1) 
+             for i,idx in enumerate(page_index)]
+
     with PdfPages(filename.with_suffix('.pdf')) as pdf:
         
-        for i in range(Npages):
+        if n_jobs>1 and 'fork' not in multiprocessing.get_all_start_methods():
+            print('parallel rendering requires the fork start method. Use n_jobs=1')
+            n_jobs = 1
+
+        if n_jobs>1:
+            _page_data.update(image=image,mask1=mask1,mask2=mask2)
+            try:
+                with ProcessPoolExecutor(n_jobs,mp_context=multiprocessing.get_context('fork')) as executor:
+                    futures = [executor.submit(_render_page,sub_positions,sub_labels,sub_pixels,nrows,ncols,figsize,last_page,dpi)
+                               for sub_positions,sub_labels,sub_pixels,last_page in pages]
+                    for i,future in enumerate(futures):
+                        print(f'working on page {i+1} of {Npages}')
+                        # embed the rendered page unresampled (and without alpha channel)
+                        fig = plt.figure(figsize=figsize,dpi=dpi)
+                        fig.figimage(plt.imread(BytesIO(future.result()))[...,:3],origin='upper')
+                        pdf.savefig(fig,dpi=dpi)
+                        plt.close(fig)
+            finally:
+                _page_data.clear()
+            return
+
+        # the same figure is reused for all pages
+        fig, axes = plt.subplots(nrows=nrows,ncols=ncols,figsize=figsize)
+        for i,(sub_positions,sub_labels,sub_pixels,last_page) in enumerate(pages):
             print(f'working on page {i+1} of {Npages}')
 
-            
-            sub_positions = positions[i*Npage:(i+1)*Npage]
-            sub_labels = labels[i*Npage:(i+1)*Npage]
+            for ax in axes.flat:
+                ax.clear()
+            cutout_page(fig,axes,sub_positions,image,mask1,mask2,labels=sub_labels,last_page=last_page,pixels=sub_pixels)
         
-            fig, axes = plt.subplots(nrows=nrows,ncols=ncols,figsize=(width,width/ncols*nrows))
-            axes_iter = iter(axes.flatten())
-
-            for position,label in zip(sub_positions,sub_labels):  
-
-                ax = next(axes_iter)
-                ax = single_cutout(ax,
-                                 position = position,
-                                 image = image,
-                                 mask1 = mask1,
-                                 mask2 = mask2,
-                                 label = label,
-                                 size  = 4*u.arcsecond)
-
-            plt.subplots_adjust(wspace=-0.1, hspace=0)
-            
-            # only the last page has subplots that need to be removed
-            if i == int(np.ceil(N/Npage))-1:
-                h,l = fig.axes[0].get_legend_handles_labels()
-                ax = next(axes_iter)
-                ax.axis('off')
-                ax.legend(h[::len(h)-1],l[::(len(l)-1)],fontsize=7,loc='center',frameon=False)
-                t = ax.text(0.06,0.87,'region ID/assoc ID', transform=ax.transAxes,color='black',fontsize=8)
-
-                for i in range(nrows*ncols-len(sub_positions)-1):
-                    # remove the empty axes at the bottom
-                    ax = next(axes_iter)
-                    ax.axis('off')    
-        
-            pdf.savefig()  # saves the current figure into a pdf page
-            plt.close()
+            pdf.savefig(fig,dpi=dpi)  # saves the current figure into a pdf page
+        plt.close(fig)
 
 
 
@@ -259,52 +488,40 @@ def plot_cluster_nebulae(name,position,size,
     ax4.set_title('HST (F275)')
     
     # plot the nebulae catalogue
-    nebulae_mask_hst, _  = reproject_interp(nebulae_mask,output_projection=hst_cutout.wcs,shape_out=hst_cutout.shape,order='nearest-neighbor')    
-    nebulae_mask_muse, _ = reproject_interp(nebulae_mask,output_projection=HA_cutout.wcs,shape_out=HA_cutout.shape,order='nearest-neighbor')    
+    nebulae_mask_hst, _  = reproject_interp(nebulae_mask,output_projection=hst_cutout.wcs,shape_out=hst_cutout.shape,order='nearest-neighbor',roundtrip_coords=False)
+    nebulae_mask_muse, _ = reproject_interp(nebulae_mask,output_projection=HA_cutout.wcs,shape_out=HA_cutout.shape,order='nearest-neighbor',roundtrip_coords=False)
+
+    outlines_hst  = find_region_contours(nebulae_mask_hst)
+    outlines_muse = find_region_contours(nebulae_mask_muse)
+
+    # the unique IDs in the cutout are already known from the outlines
+    region_ID = outlines_muse.keys()
 
-    region_ID = np.unique(nebulae_mask_muse[~np.isnan(nebulae_mask_muse)])
-    
     contours_hst_hii = []
     contours_hst_neb = []
 
     contours_muse_hii = []
     contours_muse_neb = []
 
+    HII_region_ID = set(np.asarray(HII_regions['region_ID']).tolist())
     for i in region_ID:
-        if i in HII_regions['region_ID']:
-            blank_mask = np.zeros_like(nebulae_mask_hst)
-            blank_mask[nebulae_mask_hst==i] = 1
-            contours_hst_hii += find_contours(blank_mask, 0.5)
-            
-            blank_mask = np.zeros_like(nebulae_mask_muse)
-            blank_mask[nebulae_mask_muse==i] = 1
-            contours_muse_hii += find_contours(blank_mask, 0.5)
+        if i in HII_region_ID:
+            contours_hst_hii  += outlines_hst.get(i,[])
+            contours_muse_hii += outlines_muse.get(i,[])
         else:
-            blank_mask = np.zeros_like(nebulae_mask_hst)
-            blank_mask[nebulae_mask_hst==i] = 1
-            contours_hst_neb += find_contours(blank_mask, 0.5)
-            
-            blank_mask = np.zeros_like(nebulae_mask_muse)
-            blank_mask[nebulae_mask_muse==i] = 1
-            contours_muse_neb += find_contours(blank_mask, 0.5)
-
-    cutout_mask, _  = reproject_interp(associations_mask,output_projection=hst_cutout.wcs,shape_out=hst_cutout.shape,order='nearest-neighbor')    
-    contours_hst_asc = []
-    for i in np.unique(cutout_mask[~np.isnan(cutout_mask)]):
-        blank_mask = np.zeros_like(cutout_mask)
-        blank_mask[cutout_mask==i] = 1
-        contours_hst_asc += find_contours(blank_mask, 0.5)
-
-    for coords in contours_muse_hii: 
-        ax3.plot(coords[:,1],coords[:,0],color='black',lw=0.2)
-    for coords in contours_muse_neb: 
-        ax3.plot(coords[:,1],coords[:,0],ls='--',color='black',lw=0.2)
-    for coords in contours_hst_hii:
-        ax4.plot(coords[:,1],coords[:,0],color='tab:blue',lw=0.2)
-    for coords in contours_hst_neb:
-        ax4.plot(coords[:,1],coords[:,0],ls='--',color='tab:blue',lw=0.2) 
-    for coords in contours_hst_asc:
-        ax4.plot(coords[:,1],coords[:,0],color='tab:red',lw=0.5)
+            contours_hst_neb  += outlines_hst.get(i,[])
+            contours_muse_neb += outlines_muse.get(i,[])
+
+    cutout_mask = reproject_masks([associations_mask],hst_cutout.wcs,hst_cutout.shape)[0]
+    contours_hst_asc = [c for cs in find_region_contours(cutout_mask,bkg=0).values() for c in cs]
+
+    # each group of outlines is drawn as one collection
+    for ax,contours,kwargs in [(ax3,contours_muse_hii,dict(color='black',lw=0.2)),
+                               (ax3,contours_muse_neb,dict(ls='--',color='black',lw=0.2)),
+                               (ax4,contours_hst_hii,dict(color='tab:blue',lw=0.2)),
+                               (ax4,contours_hst_neb,dict(ls='--',color='tab:blue',lw=0.2)),
+                               (ax4,contours_hst_asc,dict(color='tab:red',lw=0.5))]:
+        ax.add_collection(LineCollection([coords[:,::-1] for coords in contours],**kwargs))
 
     '''
     # mark the position of the clusters within the cutout